@@ -1,19 +1,45 @@
 from typing import Annotated, Sequence
 from typing_extensions import TypedDict
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk, SystemMessage
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
-from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import create_react_agent
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache, RedisCache
 
-import json, os
-from .prompts import REACT_SYSTEM_PROMPT
+import functools, hashlib, json, os
 from .tools_sql import SQLToolkit
 from .tools_entity import EntityResolver
+from .clients import HTTP_CLIENT
 
 from .prompts import REACT_SYSTEM_PROMPT, REACT_SYSTEM_CHARTS_PROMPT
 
+# Optional process-wide LLM response cache so repeat prompts skip the API round-trip.
+# LLM_CACHE=sqlite persists to LLM_CACHE_PATH; LLM_CACHE=redis shares across workers via REDIS_URL.
+# Only deterministic (temperature=0) models use it; sampled models opt out with cache=False.
+# Read at import, so callers load .env before importing this module.
+_llm_cache_backend = os.getenv("LLM_CACHE", "").lower()
+if _llm_cache_backend == "sqlite":
+    set_llm_cache(SQLiteCache(database_path=os.getenv("LLM_CACHE_PATH", ".langchain_cache.db")))
+elif _llm_cache_backend == "redis":
+    import redis
+    set_llm_cache(RedisCache(redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))))
+
+# Number of most recent user turns (and everything after them) kept in the prompt
+MAX_HISTORY_TURNS = int(os.getenv("AGENT_MAX_HISTORY_TURNS", "12"))
+
+
+def _trim_to_turns(messages: Sequence[BaseMessage], max_turns: int = MAX_HISTORY_TURNS) -> list:
+    """Keep only the last max_turns user turns
+    
+    Cuts at a HumanMessage boundary so an AI tool call is never separated from its ToolMessage.
+    """
+    human_idx = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+    if max_turns <= 0 or len(human_idx) <= max_turns:
+        return list(messages)
+    return list(messages[human_idx[-max_turns]:])
+
 
 class AgentState(TypedDict):
     """State for the ReAct agent"""
@@ -21,14 +47,119 @@ class AgentState(TypedDict):
     sql_error_count: int  # Track consecutive SQL errors
 
 
-def create_sql_agent(pg_url: str, whitelist_path: str, charts_enabled: bool = True):
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    """tiktoken encoding, loaded on first use since it may download the encoding file"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # Encoding files may be unavailable offline; fall back to a character estimate
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _count_tokens(text: str) -> int:
+    """Approximate prompt token count (tiktoken when available, ~4 chars/token otherwise)"""
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 4
+
+
+def _read_examples():
+    """Return the raw SQL examples list
+    
+    Prefers the module generated by scripts/compile_examples.py and falls back to parsing
+    sql_examples.json when that module is missing or was built from different JSON. Staleness
+    is checked by content hash, since mtimes are arbitrary after a checkout or Docker COPY.
+    """
+    here = os.path.dirname(__file__)
+    examples_path = os.path.join(here, "sql_examples.json")
+    if not os.path.exists(examples_path):
+        return []
+    with open(examples_path, "rb") as f:
+        raw = f.read()
+    try:
+        from . import _sql_examples_compiled as compiled
+    except ImportError:
+        compiled = None
+    if compiled is not None and getattr(compiled, "SOURCE_SHA256", None) == hashlib.sha256(raw).hexdigest():
+        return compiled.EXAMPLES
+    return json.loads(raw)
+
+
+def _load_examples():
+    """Load SQL examples once and return formatted block lists (with charts, without charts)"""
+    try:
+        ex = _read_examples()
+    except Exception:
+        return [], []
+    if not isinstance(ex, list) or len(ex) == 0:
+        return [], []
+    
+    variants = []
+    for charts_enabled in (True, False):
+        blocks = []
+        for item in ex:
+            q = item.get("question", "").strip()
+            notes = item.get("notes", "").strip()
+            sql = item.get("sql", "").strip()
+            chart_spec = item.get("chart_spec_example", "").strip()
+            if not q or not sql:
+                continue
+            block = f"Q: {q}\n" + (f"Notes: {notes}\n" if notes else "") + f"SQL:\n{sql}"
+            # Only include chart specs if charts are enabled
+            if chart_spec and charts_enabled:
+                block += f"\n\nChart Spec:\n{chart_spec}"
+            blocks.append(block)
+        variants.append(blocks)
+    return variants[0], variants[1]
+
+
+def _examples_text(charts_enabled: bool, token_budget: int = None) -> str:
+    """Join example blocks, in file order, keeping as many as fit in token_budget (all if None)"""
+    blocks = _EXAMPLES_CHART if charts_enabled else _EXAMPLES_NOCHART
+    selected = []
+    used = 0
+    for block in blocks:
+        if token_budget is not None:
+            # Only count tokens when a budget is set; counting needs the tiktoken encoding
+            tokens = _count_tokens(block)
+            if used + tokens > token_budget:
+                break
+            used += tokens
+        selected.append(block)
+    if not selected:
+        return ""
+    example_label = "Examples (Q→SQL→Chart):" if charts_enabled else "Examples (Q→SQL):"
+    return f"\n\n{example_label}\n" + "\n\n".join(selected)
+
+
+def create_sql_agent(pg_url: str, whitelist_path: str, charts_enabled: bool = True, prompt_budget: int = None, checkpointer=None):
     """Create a ReAct agent for SQL question answering with entity lookup
     
+    The agent is built once per (pg_url, whitelist_path, charts_enabled, prompt_budget, checkpointer) and reused,
+    so calling this in a request path does not rebuild tools, clients, or the prompt.
+    
     Args:
         pg_url: PostgreSQL connection URL
         whitelist_path: Path to schema whitelist JSON
         charts_enabled: If True, include charting instructions in system prompt
+        prompt_budget: Max system prompt tokens; SQL examples are dropped once it is reached.
+            Defaults to PROMPT_TOKEN_BUDGET, or no limit when unset.
+        checkpointer: Optional LangGraph checkpointer (e.g. MemorySaver) to compile the graph with, so
+            history is kept per config thread_id and each call only needs the new messages. The caller
+            owns it, including deleting threads it no longer needs; agents cache per checkpointer instance.
     """
+    if prompt_budget is None and os.getenv("PROMPT_TOKEN_BUDGET"):
+        prompt_budget = int(os.getenv("PROMPT_TOKEN_BUDGET"))
+    return _create_sql_agent_cached(pg_url, whitelist_path, bool(charts_enabled), prompt_budget, checkpointer)
+
+
+@functools.lru_cache(maxsize=4)
+def _create_sql_agent_cached(pg_url: str, whitelist_path: str, charts_enabled: bool, prompt_budget: int = None, checkpointer=None):
+    """Build the agent, toolkit, and system instructions (memoized by create_sql_agent)"""
     
     # Initialize components
     sql_toolkit = SQLToolkit(pg_url, whitelist_path)
@@ -51,51 +182,69 @@ def create_sql_agent(pg_url: str, whitelist_path: str, charts_enabled: bool = Tr
             temperature=0
         )
     else:
-        llm = ChatOpenAI(model=model_name, temperature=1)
+        llm = ChatOpenAI(
+            model=model_name,
+            temperature=1,
+            http_client=HTTP_CLIENT,
+            # Sampled output: replaying one cached completion would change behavior, not just latency
+            cache=False,
+        )
     
     # Create ReAct agent
-    # Load SQL examples if available and append to system instructions
-    examples_path = os.path.join(os.path.dirname(__file__), "sql_examples.json")
-    examples_text = ""
-    try:
-        if os.path.exists(examples_path):
-            with open(examples_path, "r", encoding="utf-8") as f:
-                ex = json.load(f)
-            if isinstance(ex, list) and len(ex) > 0:
-                blocks = []
-                for item in ex:
-                    q = item.get("question", "").strip()
-                    notes = item.get("notes", "").strip()
-                    sql = item.get("sql", "").strip()
-                    chart_spec = item.get("chart_spec_example", "").strip()
-                    if not q or not sql:
-                        continue
-                    block = f"Q: {q}\n" + (f"Notes: {notes}\n" if notes else "") + f"SQL:\n{sql}"
-                    # Only include chart specs if charts are enabled
-                    if chart_spec and charts_enabled:
-                        block += f"\n\nChart Spec:\n{chart_spec}"
-                    blocks.append(block)
-                if blocks:
-                    example_label = "Examples (Q→SQL→Chart):" if charts_enabled else "Examples (Q→SQL):"
-                    examples_text = f"\n\n{example_label}\n" + "\n\n".join(blocks)
-    except Exception:
-        examples_text = ""
-    
-    combined_system_instructions = (
+    base_instructions = (
         f"{REACT_SYSTEM_PROMPT}\n\n"
         f"{REACT_SYSTEM_CHARTS_PROMPT if charts_enabled else None}\n\n"
         "You are analyzing California education data. Stay focused on answering the user's question." 
-        f"{examples_text}"
     )
+    examples_budget = None
+    if prompt_budget is not None:
+        examples_budget = max(0, prompt_budget - _count_tokens(base_instructions))
+    combined_system_instructions = base_instructions + _examples_text(charts_enabled, examples_budget)
+    system_message = SystemMessage(content=combined_system_instructions)
+    
+    def bounded_prompt(state) -> list:
+        # Send the system prompt plus only the recent turns so prefill does not grow with the session
+        return [system_message] + _trim_to_turns(state["messages"])
+    
     agent = create_react_agent(
         llm,
         tools,
-        state_modifier=combined_system_instructions,
+        state_modifier=bounded_prompt,
+        checkpointer=checkpointer,
     )
     
     return agent, sql_toolkit, combined_system_instructions
 
 
+def _history_to_messages(history: list = None) -> list:
+    """Convert a role/content history into LangChain messages"""
+    messages = []
+    if history:
+        for msg in history:
+            if msg["role"] == "user":
+                messages.append(HumanMessage(content=msg["content"]))
+            elif msg["role"] == "assistant":
+                messages.append(AIMessage(content=msg["content"]))
+    return messages
+
+
+def _build_messages(question: str, history: list = None) -> list:
+    """Convert a role/content history plus the current question into LangChain messages"""
+    messages = _history_to_messages(history)
+    
+    # Add current question
+    messages.append(HumanMessage(content=question))
+    return messages
+
+
+def _message_text(message) -> str:
+    """Extract plain text from a message whose content may be a string or a list of content blocks"""
+    content = getattr(message, "content", message)
+    if isinstance(content, list):
+        return "".join(item.get("text", "") for item in content if isinstance(item, dict) and item.get("type") == "text")
+    return content if isinstance(content, str) else str(content)
+
+
 def run_agent_query(agent, question: str, history: list = None):
     """
     Run a query through the agent
@@ -108,17 +257,7 @@ def run_agent_query(agent, question: str, history: list = None):
     Returns:
         dict with 'response' (agent's final answer) and 'messages' (full message history)
     """
-    # Convert history to messages
-    messages = []
-    if history:
-        for msg in history:
-            if msg["role"] == "user":
-                messages.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "assistant":
-                messages.append(AIMessage(content=msg["content"]))
-    
-    # Add current question
-    messages.append(HumanMessage(content=question))
+    messages = _build_messages(question, history)
     
     # Run agent
     result = agent.invoke({"messages": messages})
@@ -131,3 +270,60 @@ def run_agent_query(agent, question: str, history: list = None):
         "response": response,
         "messages": result["messages"]
     }
+
+
+def stream_agent_text(agent, messages: list):
+    """
+    Stream the agent (LLM) node's text for a message list, skipping tool calls and tool outputs
+    
+    Yields (message_id, text, complete). Token chunks arrive as deltas (complete=False). A message
+    that was not streamed, e.g. an LLM_CACHE hit, arrives once as a whole AIMessage (complete=True)
+    and replaces any text received so far for that id.
+    """
+    for message, metadata in agent.stream({"messages": messages}, stream_mode="messages"):
+        if metadata.get("langgraph_node") != "agent" or not isinstance(message, AIMessage):
+            continue
+        yield message.id, _message_text(message), not isinstance(message, AIMessageChunk)
+
+
+async def run_agent_batch(agent, questions: list[str], histories: list = None, max_concurrency: int = None, sql_toolkit: SQLToolkit = None):
+    """
+    Run several independent questions through the agent concurrently
+    
+    The runs share the agent's memoized SQLToolkit, whose retry counter and last query/error are a
+    single per-toolkit state: during a batch, one question's SQL failures count against the others'
+    retry budget and last_query_text/last_error_text reflect whichever run wrote last. The counter is
+    reset once before the batch starts. When per-question retry limits matter, run the questions one at
+    a time with run_agent_query (calling sql_toolkit.reset_error_count() before each).
+    
+    Args:
+        agent: The LangGraph agent
+        questions: List of user questions
+        histories: Optional list of histories, one per question (same format as run_agent_query)
+        max_concurrency: Maximum in-flight agent runs. Defaults to AGENT_MAX_CONCURRENCY (10).
+            Always set explicitly: some provider integrations otherwise fall back to
+            running batch inputs one at a time. Keep it under the provider's rate limits.
+        sql_toolkit: The toolkit returned with agent by create_sql_agent; its retry counter is reset first
+    
+    Returns:
+        list of dicts with 'response' and 'messages', in the same order as questions
+    """
+    if max_concurrency is None:
+        max_concurrency = int(os.getenv("AGENT_MAX_CONCURRENCY", "10"))
+    histories = histories or [None] * len(questions)
+    
+    inputs = [{"messages": _build_messages(q, h)} for q, h in zip(questions, histories)]
+    if sql_toolkit is not None:
+        sql_toolkit.reset_error_count()
+    results = await agent.abatch(inputs, config={"max_concurrency": max_concurrency})
+    
+    out = []
+    for result in results:
+        final_message = result["messages"][-1]
+        response = final_message.content if hasattr(final_message, 'content') else str(final_message)
+        out.append({"response": response, "messages": result["messages"]})
+    return out
+
+
+# Examples prompt blocks and their token counts, computed once at import for both chart settings
+_EXAMPLES_CHART, _EXAMPLES_NOCHART = _load_examples()
@@ -0,0 +1,16 @@
+import os
+import httpx
+
+# Shared, pooled HTTP client for sync OpenAI calls so TCP/TLS connections are reused
+# across LLM and embedding requests instead of being set up per client instance.
+# Async calls keep the SDK's own client: an httpx.AsyncClient's pool is bound to the
+# event loop it first ran on and breaks when reused from the next asyncio.run.
+_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "20")),
+)
+# Only override the timeout when asked: the SDK adopts a custom client's timeout in place of its
+# own 600s default unless the client keeps httpx's default
+_TIMEOUT = {"timeout": float(os.environ["OPENAI_HTTP_TIMEOUT"])} if os.getenv("OPENAI_HTTP_TIMEOUT") else {}
+
+HTTP_CLIENT = httpx.Client(limits=_LIMITS, **_TIMEOUT)
@@ -136,6 +136,11 @@ REACT_SYSTEM_CHARTS_PROMPT = """7. Chart suggestion and data block (CRITICAL for
      
      🥧 PERFORMANCE BAND BREAKDOWN (single group) → "pie"
         • Showing pct_exceeded/pct_met/pct_nearly_met/pct_not_met for ONE entity
+     
+     📋 LONG LISTINGS (more than 50 rows) → "table" with a SQL source
+        • Do NOT copy the rows into "data"; leave "data" empty
+        • Add "source": {"sql": "<the exact SQL string you ran with sql_db_query; it must have an ORDER BY>"} and "page_size": 50
+        • The UI runs that SQL itself and pages through the results
    
    - Keep data concise (<= 50 rows).
    - Always include the minimal fields needed (x/y/series or value and data) so the UI can render without re-running SQL.
@@ -1,9 +1,8 @@
-import os
+import asyncio, functools, os
 from langchain_openai import OpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone
 from langchain.tools import Tool
-from langchain_core.documents import Document
+from .clients import HTTP_CLIENT
 
 class EntityResolver:
     """Pinecone-based entity resolver for high-cardinality columns"""
@@ -22,18 +21,32 @@ class EntityResolver:
         
         if self.enabled:
             index_name = os.getenv("PINECONE_INDEX_NAME", "eduanalytics-entities")
-            self.embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+            self.embeddings = OpenAIEmbeddings(
+                # Must match the model the ingest flow built the index with
+                model=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+                http_client=HTTP_CLIENT,
+            )
             self.vector_store = PineconeVectorStore(
                 index_name=index_name, 
                 embedding=self.embeddings
             )
+            # Per-instance LRU of query embeddings; agents resolve the same names repeatedly
+            self._embed_query_cached = functools.lru_cache(maxsize=4096)(self._embed_query)
+    
+    def _embed_query(self, text: str) -> tuple:
+        return tuple(self.embeddings.embed_query(text))
+    
+    def _similarity_search(self, text: str, k: int):
+        """Similarity search that reuses cached embeddings for repeated lookups"""
+        vector = self._embed_query_cached(text.strip())
+        return self.vector_store.similarity_search_by_vector(list(vector), k=k)
     
     def search(self, text: str, k=5):
         """Search for similar entities"""
         if not self.enabled:
             return []
         
-        results = self.vector_store.similarity_search(text, k=k)
+        results = self._similarity_search(text, k=k)
         return [doc.metadata for doc in results]
     
     def search_as_text(self, text: str, k=5) -> str:
@@ -41,7 +54,7 @@ class EntityResolver:
         if not self.enabled:
             return "Entity search is not available."
         
-        results = self.vector_store.similarity_search(text, k=k)
+        results = self._similarity_search(text, k=k)
         
         if not results:
             return "No matching entities found."
@@ -63,6 +76,10 @@ class EntityResolver:
         
         return "\n".join(output_lines)
     
+    async def asearch_as_text(self, text: str, k=5) -> str:
+        """Async search_as_text so agent.ainvoke/astream can overlap lookups with other I/O"""
+        return await asyncio.to_thread(self.search_as_text, text, k)
+    
     def as_tool(self) -> Tool:
         """Create a LangChain Tool for the agent"""
         return Tool(
@@ -74,5 +91,6 @@ class EntityResolver:
                 "Each entity has a combination of the county code, district code, and school code and can be used to filter on the same fields in the fact_scores table."
                 "ALWAYS use this tool before filtering on entity names, subject/test subgroups, or grades."
             ),
-            func=self.search_as_text
+            func=self.search_as_text,
+            coroutine=self.asearch_as_text,
         )
@@ -1,96 +1,243 @@
-import json, os, re
+import asyncio, functools, io, logging, os, re, threading
+import orjson
+from cachetools import LRUCache, TTLCache
 from sqlalchemy import create_engine, text
 from langchain_community.utilities import SQLDatabase
-from langchain_community.tools.sql_database.tool import (
-    InfoSQLDatabaseTool,
-    ListSQLDatabaseTool,
-    QuerySQLDataBaseTool,
-)
 from langchain.tools import Tool
 
+log = logging.getLogger(__name__)
+
+# Statements the agent may never run; word boundaries avoid matching identifiers like created_at
+_FORBIDDEN = re.compile(r"\b(insert|update|delete|drop|alter|create|truncate)\b", re.IGNORECASE)
+
+# A trailing statement terminator, optionally followed by a line comment
+_TRAILING_END_RE = re.compile(r";\s*(?:--[^\n]*)?\s*$")
+_SELECT_START_RE = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+_FACT_TABLE_RE = re.compile(r"fact_scores", re.IGNORECASE)
+_ORDER_BY_RE = re.compile(r"\border\s+by\b", re.IGNORECASE)
+
+# Dimensions every analytics.fact_scores query must filter on (rows are pre-aggregated per combination)
+_FACT_DIMENSIONS = ("county_code", "district_code", "school_code", "subgroup", "grade", "test_id")
+
+
+# Tool descriptions shown to the LLM; QUERY_TOOL_DESCRIPTION is formatted with max_attempts
+LIST_TABLES_DESCRIPTION = "List available tables (from whitelist)."
+SCHEMA_DESCRIPTION = "Get table schemas (from whitelist). Use fully-qualified names like analytics.fact_scores."
+QUERY_TOOL_DESCRIPTION = (
+    "Execute a SQL query against the database and get results. "
+    "Input should be a valid SQL SELECT query. "
+    "\n\n"
+    "⚠️ CRITICAL: Each row is a PRE-AGGREGATED statistic. You MUST filter on ALL dimensions:\n"
+    "   • county_code/school_code/district_code: If NO entity mentioned → '00'/'00000'/'0000000' (statewide). If mentioned → call search_proper_nouns\n"
+    "   • subgroup: If NO subgroup mentioned → '1' (all students). If mentioned → call search_proper_nouns\n"
+    "   • grade: If NO grade mentioned → '13' (all grades). If mentioned → call search_proper_nouns\n"
+    "   • test_id: If NO test mentioned → IN ('1','2') + GROUP BY test_id. If 'ELA' → '1', if 'Math' → '2'\n"
+    "\n"
+    "Other Rules:\n"
+    "- Only SELECT queries (no INSERT, UPDATE, DELETE, DROP, etc.)\n"
+    "- ALWAYS use fully-qualified table names like analytics.fact_scores\n"
+    "- Use COALESCE(column, 0) in ALL aggregations and in ORDER BY for rankings\n"
+    "- For 'latest year', use MAX(year_key) or ORDER BY year_key DESC LIMIT 1\n"
+    "- You have up to {max_attempts} attempts to fix errors before giving up\n"
+)
+
+
+def _engine_options() -> dict:
+    """Connection pool settings shared by every engine the toolkit creates
+    
+    LIFO checkout keeps reusing the most recently returned connection, so idle
+    ones age out instead of all staying warm under bursty agent traffic.
+    Set DB_POOL_PRE_PING=false behind a transaction-mode PgBouncer and rely on
+    a DB_POOL_RECYCLE below its server_idle_timeout instead.
+    """
+    return {
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+        "pool_use_lifo": True,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        # Larger compiled-statement cache for the many distinct LLM-written queries
+        "query_cache_size": int(os.getenv("DB_QUERY_CACHE_SIZE", "1200")),
+    }
+
+
+@functools.lru_cache(maxsize=4)
+def _get_engine(pg_url: str):
+    """The one pooled engine per URL, shared by the toolkit and its SQLDatabase"""
+    return create_engine(pg_url, **_engine_options())
+
+
+@functools.lru_cache(maxsize=4)
+def _get_sqldb(pg_url: str, sample_rows: int) -> SQLDatabase:
+    """Create (once per URL) the SQLDatabase used for table info, on the shared engine"""
+    # No schema is set here (avoids SET search_path issues)
+    return SQLDatabase(_get_engine(pg_url), sample_rows_in_table_info=sample_rows)
+
+
+def _is_mutation(sql: str) -> bool:
+    """Return True if the SQL contains a data- or schema-modifying keyword"""
+    return _FORBIDDEN.search(sql) is not None
+
+
+def _subquery_body(sql: str):
+    """SELECT/WITH text with trailing semicolons (and comments after them) removed, ready to wrap
+    
+    Returns None when the text is not a single SELECT/WITH statement, so callers run it as written.
+    """
+    if not _SELECT_START_RE.match(sql):
+        return None
+    body = sql.strip()
+    while True:
+        stripped = _TRAILING_END_RE.sub("", body).rstrip()
+        if stripped == body:
+            break
+        body = stripped
+    if ";" in body:
+        # Several statements (or a semicolon we can't place safely); wrapping would break them
+        return None
+    return body
+
+
+def _missing_dimensions(sql: str) -> list:
+    """analytics.fact_scores dimensions the query never mentions (empty if it doesn't touch the fact table)"""
+    # Only lowercase a copy when the fact table is actually referenced
+    if not _FACT_TABLE_RE.search(sql):
+        return []
+    lower = sql.lower()
+    return [dim for dim in _FACT_DIMENSIONS if dim not in lower]
+
+
+def _sql_fingerprint(sql: str):
+    """Whitespace-insensitive identity of a single SELECT/WITH statement, or None"""
+    body = _subquery_body(sql)
+    return " ".join(body.split()) if body is not None else None
+
+
+def _with_limit(sql: str, limit: int) -> str:
+    """Wrap a SELECT/WITH query so Postgres stops producing rows at `limit`
+    
+    Always wraps, since a LIMIT inside a subquery or CTE does not bound the outer result.
+    The body sits on its own lines so a trailing -- comment can't swallow the closing paren.
+    """
+    body = _subquery_body(sql)
+    if body is None:
+        return sql
+    return f"SELECT * FROM (\n{body}\n) AS _sub LIMIT {limit}"
+
 class SQLToolkit:
     """Toolkit for SQL database operations with LangChain agent"""
     
-    def __init__(self, pg_url: str, whitelist_path: str):
-        self.engine = create_engine(pg_url, pool_pre_ping=True)
+    # Fixed attribute set: smaller instances and slot-speed writes on the retry counters
+    __slots__ = (
+        "query_tool_description", "engine", "db", "schema", "table_keys",
+        "last_query_text", "last_error_text", "last_query_succeeded", "error_count", "max_attempts",
+        "row_cap", "char_cap", "auto_limit",
+        "_table_list_str", "_schema_info_str", "_table_info_cache",
+        "_retry_tools", "_result_cache", "_result_cache_lock", "_accepted_sql",
+    )
+    
+    def __init__(self, pg_url: str, whitelist_path: str, *, query_tool_description: str = QUERY_TOOL_DESCRIPTION):
+        self.query_tool_description = query_tool_description
+        # Same engine as self.db below, so each URL has a single connection pool
+        self.engine = _get_engine(pg_url)
         self.last_query_text = None
         self.last_error_text = None
+        self.last_query_succeeded = True
 
         # Load schema whitelist
-        with open(whitelist_path, "r") as f:
-            self.schema = json.load(f)
+        with open(whitelist_path, "rb") as f:
+            self.schema = orjson.loads(f.read())
 
         # Keep whitelist table keys as fully-qualified names
         self.table_keys = list(self.schema.get("tables", {}).keys())
 
-        # Create SQLDatabase instance without setting schema (avoids SET search_path issues)
-        self.db = SQLDatabase.from_uri(
-            pg_url,
-            sample_rows_in_table_info=3,
+        # The whitelist is immutable per process, so build the tool outputs once
+        self._table_list_str = ", ".join(self.table_keys)
+        self._schema_info_str = "\n\n".join(
+            f"Table: {tbl}\nColumns: {', '.join(cols)}"
+            for tbl, cols in self.schema.get("tables", {}).items()
         )
+        self._table_info_cache = None
+
+        # Shared SQLDatabase so metadata reflection runs once per process, not per toolkit
+        self.db = _get_sqldb(pg_url, 3)
         
         # Track SQL query errors for retry limit
         self.error_count = 0
         self.max_attempts = 4
+
+        # Bounds on what a single agent query returns to the LLM
+        self.row_cap = int(os.getenv("SQL_TOOL_ROW_CAP", "200"))
+        self.char_cap = int(os.getenv("SQL_TOOL_CHAR_CAP", "8000"))
+        self.auto_limit = int(os.getenv("SQL_AUTO_LIMIT", "1000"))
+
+        # Tool lists built by get_tools_with_retry_limit, keyed by max_attempts
+        self._retry_tools = {}
+
+        # Short-lived cache of successful results keyed by SQL text. Safe because mutations are
+        # rejected before execution; retries and re-asked questions skip the database.
+        self._result_cache = TTLCache(
+            maxsize=int(os.getenv("SQL_RESULT_CACHE_SIZE", "256")),
+            ttl=int(os.getenv("SQL_RESULT_CACHE_TTL", "60")),
+        )
+        self._result_cache_lock = threading.Lock()
+        # Fingerprints of queries the agent's tool ran successfully; run_page only pages these
+        self._accepted_sql = LRUCache(maxsize=int(os.getenv("SQL_ACCEPTED_CACHE_SIZE", "1024")))
     
     def get_tools_with_retry_limit(self, max_attempts: int = 4):
-        """Return list of SQL tools with retry limit for query errors"""
+        """Return list of SQL tools with retry limit for query errors
+        
+        Tools are built once per max_attempts and reused; only the error counters are reset.
+        """
         
         self.max_attempts = max_attempts
         self.error_count = 0
         self.last_query_succeeded = True
         
+        if max_attempts not in self._retry_tools:
+            self._retry_tools[max_attempts] = self._build_tools(max_attempts)
+        # Return a copy so callers can append their own tools
+        return list(self._retry_tools[max_attempts])
+    
+    def _build_tools(self, max_attempts: int):
+        """Build the list tables, schema, and query tools"""
+        
         # List tables tool (from whitelist)
         def list_tables_impl(_: str = "") -> str:
-            return ", ".join(self.table_keys)
+            return self._table_list_str
 
         list_tables_tool = Tool(
             name="sql_db_list_tables",
-            description="List available tables (from whitelist).",
+            description=LIST_TABLES_DESCRIPTION,
             func=list_tables_impl,
         )
 
         # Get schema tool (from whitelist)
         def schema_info_impl(_: str = "") -> str:
-            parts = []
-            for tbl, cols in self.schema.get("tables", {}).items():
-                parts.append(f"Table: {tbl}\nColumns: {', '.join(cols)}")
-            return "\n\n".join(parts)
+            return self._schema_info_str
 
         get_schema_tool = Tool(
             name="sql_db_schema",
-            description=(
-                "Get table schemas (from whitelist). Use fully-qualified names like analytics.fact_scores."
-            ),
+            description=SCHEMA_DESCRIPTION,
             func=schema_info_impl,
         )
         
-        # Query tool with safety wrapper and retry limit
+        # Query tool with safety wrapper and retry limit.
+        # Resolve the runner once; the closure is called for every LLM-generated query.
+        run_bounded = self._run_bounded
+        
         def safe_query_with_retry_limit(query: str) -> str:
             """Execute SQL query with safety checks and retry limit"""
             # Safety check - block non-SELECT queries
-            lower = query.lower().strip()
-            if any(x in lower for x in ["insert", "update", "delete", "drop", "alter", "create", "truncate"]):
+            if _is_mutation(query):
                 return "Error: Only SELECT queries are allowed."
             
             # Check if we are querying fact_scores. If so, check if there is a filter on every dimension.
-            error_msg = "Error: You must filter on every dimension. "
-            if "fact_scores" in query.lower():
-                if "county_code" not in query.lower():
-                    error_msg += "You did not filter on county_code. "
-                if "district_code" not in query.lower():
-                    error_msg += "You did not filter on district_code. "
-                if "school_code" not in query.lower():
-                    error_msg += "You did not filter on school_code. "
-                if "subgroup" not in query.lower():
-                    error_msg += "You did not filter on subgroup. "
-                if "grade" not in query.lower():
-                    error_msg += "You did not filter on grade. "
-                if "test_id" not in query.lower():
-                    error_msg += "You did not filter on test_id. "
-
-            if error_msg != "Error: You must filter on every dimension. ":
-                return error_msg
+            missing = _missing_dimensions(query)
+            if missing:
+                return "Error: You must filter on every dimension. " + "".join(
+                    f"You did not filter on {dim}. " for dim in missing
+                )
             
             # Check if we've exceeded retry limit
             if self.error_count >= self.max_attempts:
@@ -100,9 +247,20 @@ class SQLToolkit:
                     "Please try rephrasing your question or ask something else."
                 )
             
+            # Push truncation into the executor for unbounded SELECTs
+            bounded = _with_limit(query, self.auto_limit)
+            
             try:
+                # Keep the SQL as the model wrote it for the dev panel
                 self.last_query_text = query
-                result = self.db.run(query)
+                result = self._cache_get(("text", bounded))
+                if result is None:
+                    result = run_bounded(bounded)
+                    self._cache_put(("text", bounded), result)
+                fingerprint = _sql_fingerprint(query)
+                if fingerprint is not None:
+                    with self._result_cache_lock:
+                        self._accepted_sql[fingerprint] = True
                 # Reset error count on success
                 self.error_count = 0
                 self.last_query_succeeded = True
@@ -124,49 +282,122 @@ class SQLToolkit:
                 
                 return error_msg
         
+        async def asafe_query_with_retry_limit(query: str) -> str:
+            # The LangChain SQLDatabase/toolkit path is synchronous; keep it off the event loop
+            return await asyncio.to_thread(safe_query_with_retry_limit, query)
+        
         query_tool = Tool(
             name="sql_db_query",
-            description=(
-                "Execute a SQL query against the database and get results. "
-                "Input should be a valid SQL SELECT query. "
-                "\n\n"
-                "⚠️ CRITICAL: Each row is a PRE-AGGREGATED statistic. You MUST filter on ALL dimensions:\n"
-                "   • county_code/school_code/district_code: If NO entity mentioned → '00'/'00000'/'0000000' (statewide). If mentioned → call search_proper_nouns\n"
-                "   • subgroup: If NO subgroup mentioned → '1' (all students). If mentioned → call search_proper_nouns\n"
-                "   • grade: If NO grade mentioned → '13' (all grades). If mentioned → call search_proper_nouns\n"
-                "   • test_id: If NO test mentioned → IN ('1','2') + GROUP BY test_id. If 'ELA' → '1', if 'Math' → '2'\n"
-                "\n"
-                "Other Rules:\n"
-                "- Only SELECT queries (no INSERT, UPDATE, DELETE, DROP, etc.)\n"
-                "- ALWAYS use fully-qualified table names like analytics.fact_scores\n"
-                "- Use COALESCE(column, 0) in ALL aggregations and in ORDER BY for rankings\n"
-                "- For 'latest year', use MAX(year_key) or ORDER BY year_key DESC LIMIT 1\n"
-                f"- You have up to {max_attempts} attempts to fix errors before giving up\n"
-            ),
-            func=safe_query_with_retry_limit
+            description=self.query_tool_description.format(max_attempts=max_attempts),
+            func=safe_query_with_retry_limit,
+            coroutine=asafe_query_with_retry_limit,
         )
         
         return [list_tables_tool, get_schema_tool, query_tool]
     
+    def _run_bounded(self, query: str, row_cap: int = None, char_cap: int = None) -> str:
+        """Run a query for the agent, streaming rows and stopping at row_cap rows or char_cap characters
+        
+        Output matches SQLDatabase.run (a list of row tuples as text, "" when empty) so the
+        LLM sees the same format, but the full result set is never buffered in memory.
+        """
+        row_cap = row_cap or self.row_cap
+        char_cap = char_cap or self.char_cap
+        sio = io.StringIO()
+        n_rows = 0
+        truncated = False
+        with self.engine.connect() as con:
+            result = con.execution_options(stream_results=True, yield_per=row_cap).execute(text(query))
+            for row in result:
+                if n_rows >= row_cap or sio.tell() >= char_cap:
+                    truncated = True
+                    break
+                sio.write(", " if n_rows else "[")
+                sio.write(repr(tuple(row)))
+                n_rows += 1
+        if n_rows == 0:
+            return ""
+        sio.write("]")
+        out = sio.getvalue()
+        if len(out) > char_cap:
+            out = out[:char_cap]
+            truncated = True
+        if truncated:
+            out += f"\n\n(Result truncated after {n_rows} rows. Aggregate further or add a LIMIT.)"
+        return out
+
+    def _cache_get(self, key):
+        with self._result_cache_lock:
+            return self._result_cache.get(key)
+    
+    def _cache_put(self, key, value):
+        with self._result_cache_lock:
+            self._result_cache[key] = value
+    
     def reset_error_count(self):
         """Reset the error count for a new question"""
         self.error_count = 0
         self.last_query_succeeded = True
     
-    def get_table_info(self) -> str:
-        """Get information about all tables in the database"""
-        return self.db.get_table_info()
+    def get_table_info(self, refresh: bool = False) -> str:
+        """Get information about all tables in the database (cached after the first call)"""
+        if self._table_info_cache is None or refresh:
+            self._table_info_cache = self.db.get_table_info()
+        return self._table_info_cache
     
     def run_query(self, query: str):
         """Execute a query and return results as list of dicts"""
-        lower = query.lower().strip()
-        if any(x in lower for x in ["insert", "update", "delete", "drop", "alter", "create", "truncate"]):
+        if _is_mutation(query):
             return []
         
+        cached = self._cache_get(("rows", query))
+        if cached is not None:
+            return list(cached)
+        
         try:
-            with self.engine.begin() as con:
-                rows = con.execute(text(query)).fetchall()
-                return [dict(r._mapping) for r in rows]
-        except Exception as e:
-            print(f"Error executing query: {e}")
+            rows = []
+            # Server-side cursor: fetch in batches instead of buffering the whole result set
+            with self.engine.connect() as con:
+                result = con.execution_options(stream_results=True, yield_per=1000).execute(text(query))
+                # Build dicts from one prefetched key tuple rather than a per-row mapping view
+                keys = tuple(result.keys())
+                for part in result.partitions():
+                    rows.extend(dict(zip(keys, r)) for r in part)
+            self._cache_put(("rows", query), rows)
+            return list(rows)
+        except Exception:
+            log.exception("Error executing query %s", query)
             return []
+    
+    def run_page(self, query: str, limit: int, offset: int = 0):
+        """Return rows [offset, offset + limit) of a query the agent already ran, as a list of dicts
+        
+        The query is wrapped so Postgres does the paging; used by the UI to page table charts
+        that reference their SQL instead of embedding every row. Only SQL the query tool accepted
+        and ran (same safety and dimension checks), with an ORDER BY so pages are stable, is run.
+        Returns None when the query is refused or fails, [] when the page is empty.
+        """
+        fingerprint = _sql_fingerprint(query)
+        if fingerprint is None or _is_mutation(query) or _missing_dimensions(query):
+            return None
+        with self._result_cache_lock:
+            accepted = fingerprint in self._accepted_sql
+        if not accepted or not _ORDER_BY_RE.search(fingerprint):
+            return None
+        
+        key = ("page", fingerprint, limit, offset)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return list(cached)
+        
+        paged = f"SELECT * FROM (\n{_subquery_body(query)}\n) AS _page LIMIT :limit OFFSET :offset"
+        try:
+            with self.engine.connect() as con:
+                result = con.execute(text(paged), {"limit": int(limit), "offset": int(offset)})
+                keys = tuple(result.keys())
+                rows = [dict(zip(keys, r)) for r in result]
+            self._cache_put(key, rows)
+            return list(rows)
+        except Exception:
+            log.exception("Error executing query %s", query)
+            return None
@@ -34,6 +34,15 @@ CREATE TABLE IF NOT EXISTS analytics.fact_scores (
   school_code TEXT
 );
 
+-- What the Pinecone entity index currently holds, per vector id (digest of model/text/metadata
+-- as last upserted). Not dropped above: it tracks external state that outlives a schema reset.
+CREATE TABLE IF NOT EXISTS analytics.vector_index_state (
+  index_name TEXT NOT NULL,
+  id TEXT NOT NULL,                   -- ent:<cds_code>, sub:<id>, test:<id>, grade:<n>
+  digest BYTEA NOT NULL,
+  PRIMARY KEY (index_name, id)
+);
+
 -- Composite index for common query patterns (year, subject, grade, subgroup)
 CREATE INDEX IF NOT EXISTS idx_scores_keys
   ON analytics.fact_scores (year_key, test_id, grade, subgroup);
@@ -1,8 +1,40 @@
 import os
 from pathlib import Path
+from dotenv import load_dotenv
+
+# Settings below are read at import, so .env has to be loaded first (existing env vars win)
+load_dotenv()
 
 DATA_DIR = Path(os.getenv("DATA_DIR", "./data"))
-DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def ensure_data_dir() -> Path:
+    """Create DATA_DIR if needed; called from ingest entry points rather than at import"""
+    if not DATA_DIR.exists():
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+    return DATA_DIR
+
+# Embedding model for the Pinecone entity index; must match the app's EntityResolver (same env var)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIMS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+
+def embedding_dimension() -> int:
+    """Vector size of EMBEDDING_MODEL; EMBEDDING_DIMENSIONS declares it for models not listed above"""
+    override = os.getenv("EMBEDDING_DIMENSIONS")
+    if override:
+        return int(override)
+    try:
+        return EMBEDDING_DIMS[EMBEDDING_MODEL]
+    except KeyError:
+        raise ValueError(
+            f"Unknown dimension for EMBEDDING_MODEL={EMBEDDING_MODEL!r}; set EMBEDDING_DIMENSIONS "
+            f"(known models: {', '.join(EMBEDDING_DIMS)})"
+        ) from None
 
 # Smarter Balanced research list page for a given year
 CAASPP_LIST = "https://caaspp-elpac.ets.org/caaspp/ResearchFileListSB.aspx?lstCounty=00&lstDistrict=00000&lstTestType=B&lstTestYear={year}&ps=true"
@@ -0,0 +1,45 @@
+import hashlib, sqlite3
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from .config import DATA_DIR
+
+# SQLite caps bound parameters per statement (999 on older builds)
+_IN_CHUNK = 900
+
+
+class EmbeddingCache:
+    """SQLite-backed map of sha256(model + "\\0" + text) -> float32 vector bytes, persisted under DATA_DIR"""
+
+    def __init__(self, model: str, path: Optional[Path] = None):
+        self.model = model
+        self.path = Path(path) if path else DATA_DIR / "embed_cache.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS emb (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256((self.model + "\0" + text).encode("utf-8")).digest()
+
+    def get_many(self, texts: list[str]) -> list[Optional[list[float]]]:
+        """Return cached vectors aligned with texts, None for misses"""
+        keys = [self.key(t) for t in texts]
+        found: dict[bytes, bytes] = {}
+        for i in range(0, len(keys), _IN_CHUNK):
+            chunk = keys[i:i+_IN_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(self.conn.execute(f"SELECT key, vec FROM emb WHERE key IN ({placeholders})", chunk))
+        return [
+            np.frombuffer(found[k], dtype=np.float32).tolist() if k in found else None
+            for k in keys
+        ]
+
+    def put_many(self, texts: list[str], vectors: list[list[float]]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO emb (key, vec) VALUES (?, ?)",
+                ((self.key(t), np.asarray(v, dtype=np.float32).tobytes()) for t, v in zip(texts, vectors)),
+            )
+
+    def close(self) -> None:
+        self.conn.close()
@@ -1,15 +1,18 @@
-import os, re, datetime, json, zipfile, io
+import os, re, datetime, json, zipfile, io, uuid, hashlib, tempfile, html
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 import requests, polars as pl, numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from prefect import flow, task, get_run_logger
+from prefect.task_runners import ThreadPoolTaskRunner
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from pinecone import Pinecone, ServerlessSpec
-from pinecone.core.openapi.shared.exceptions import NotFoundException
 from langchain_openai import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-from .config import DATA_DIR, CAASPP_LIST, STUDENT_GROUPS_URL, TESTS_URL
-from .transforms import parse_zip_caret, parse_student_groups, parse_tests
+from .config import DATA_DIR, CAASPP_LIST, STUDENT_GROUPS_URL, TESTS_URL, EMBEDDING_MODEL, embedding_dimension, ensure_data_dir
+from .embed_cache import EmbeddingCache
+from .transforms import parse_zip_caret, parse_student_groups, parse_tests, TESTS_COLUMNS, ENTITY_COLUMNS, PARSER_VERSION
 import time
 
 load_dotenv()
@@ -18,77 +21,186 @@ PG_URL = (
     f"@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
 )
 
+# One pooled keep-alive session for all downloads (list pages, reference files, zips)
+_HTTP_POOL = int(os.getenv("HTTP_POOL_SIZE", "16"))
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=_HTTP_POOL,
+    pool_maxsize=_HTTP_POOL,
+    # Retry connection errors and transient statuses in place, before falling back to the task-level retry
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
 @task(retries=2, retry_delay_seconds=5)
 def http_get(url: str) -> bytes:
-    r = requests.get(url, timeout=90)
+    r = _SESSION.get(url, timeout=90)
     r.raise_for_status()
     return r.content
 
+@task(retries=2, retry_delay_seconds=5)
+def http_download(url: str, suffix: str = ".zip") -> str:
+    """Stream a large file to a temp path (caller removes it) instead of holding it in memory"""
+    with _SESSION.get(url, stream=True, timeout=90) as r:
+        r.raise_for_status()
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+    return path
+
+# .zip links on the research file list page
+_ZIP_HREF_RE = re.compile(rb'href="([^"]+\.zip)"', re.IGNORECASE)
+# Smarter Balanced files with CSV format and "all" (combined data), excluding subject-specific (math/ela only) files
+_SB_ALL_CSV_RE = re.compile(r"^(?=.*sb_)(?=.*csv)(?=.*all)(?!.*math)(?!.*ela)", re.IGNORECASE | re.DOTALL)
+
 @task
 def caret_zip_urls(list_html: bytes) -> list[str]:
     logger = get_run_logger()
-    hrefs = re.findall(rb'href="([^"]+\.zip)"', list_html, re.IGNORECASE)
-    logger.info(f"Found {len(hrefs)} total .zip hrefs in HTML")
     
+    n_hrefs = 0
     out = []
-    for h in hrefs:
-        u = h.decode("utf-8")
+    for m in _ZIP_HREF_RE.finditer(list_html):
+        n_hrefs += 1
+        # Attribute values can carry entities (e.g. &amp; in query strings)
+        u = html.unescape(m.group(1).decode("utf-8"))
         if u.startswith("/"):
             u = "https://caaspp-elpac.ets.org" + u
         
-        # Look for Smarter Balanced files with CSV format and "all" (combined data)
-        # Exclude subject-specific files (math/ela only)
-        if "sb_" in u.lower() and "csv" in u.lower() and "all" in u.lower() and "math" not in u.lower() and "ela" not in u.lower():
+        if _SB_ALL_CSV_RE.match(u):
             out.append(u)
     
+    logger.info(f"Found {n_hrefs} total .zip hrefs in HTML")
     logger.info(f"Returning {len(out)} matching URLs")
     return list(dict.fromkeys(out))
 
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Parser identity: changing the projected columns or PARSER_VERSION starts a fresh cache
+_PARSE_CACHE_TAG = hashlib.sha256(
+    json.dumps([PARSER_VERSION, sorted(TESTS_COLUMNS), sorted(ENTITY_COLUMNS)]).encode("utf-8")
+).hexdigest()[:12]
+
+def parse_zip_cached(zip_path: str, logger=None) -> dict:
+    """parse_zip_caret, memoized as Parquet under DATA_DIR/cache/<sha256 of the zip>-<parser tag>"""
+    cache_dir = DATA_DIR / "cache" / f"{_sha256_file(zip_path)}-{_PARSE_CACHE_TAG}"
+    done = cache_dir / "_SUCCESS"
+    if done.exists():
+        if logger is not None:
+            logger.info(f"Parse cache hit: {cache_dir.name}")
+        return {
+            part: pl.read_parquet(cache_dir / f"{part}.parquet") if (cache_dir / f"{part}.parquet").exists() else None
+            for part in ("entities", "tests")
+        }
+
+    parts = parse_zip_caret(zip_path, logger=logger)
+    if all(df is None for df in parts.values()):
+        # Nothing recognized (or the parse failed) - don't pin that result
+        return parts
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for part, df in parts.items():
+        if df is not None:
+            tmp = cache_dir / f"{part}.parquet.tmp"
+            df.write_parquet(tmp)
+            os.replace(tmp, cache_dir / f"{part}.parquet")
+    done.touch()
+    return parts
+
+@task
+def parse_zip_task(zip_path: str) -> dict:
+    """Parse a downloaded zip on a worker thread (overlapping other downloads/parses), then remove it"""
+    try:
+        return parse_zip_cached(zip_path, logger=get_run_logger())
+    finally:
+        os.remove(zip_path)
+
 @task
 def ensure_years(engine, latest_year: int, last_years: int):
+    years = list(range(latest_year - last_years + 1, latest_year + 1))
     with engine.begin() as con:
-        for y in range(latest_year - last_years + 1, latest_year + 1):
-            con.execute(text("""
-                INSERT INTO analytics.dim_year(year_key,label)
-                VALUES(:y,:l)
-                ON CONFLICT (year_key) DO NOTHING
-            """), {"y": y, "l": f"AY {y}-{y+1}"})
+        con.execute(text("""
+            INSERT INTO analytics.dim_year(year_key,label)
+            SELECT y, 'AY ' || y || '-' || (y + 1)
+            FROM unnest(CAST(:ys AS int[])) AS t(y)
+            ON CONFLICT (year_key) DO NOTHING
+        """), {"ys": years})
+
+# Columns load_tests stages, in COPY order, with the Polars dtype matching each analytics.fact_scores column
+SCORE_SCHEMA = {
+    "subgroup": pl.Int32, "grade": pl.Int32,
+    "tested": pl.Float64, "tested_with_scores": pl.Float64, "mean_scale_score": pl.Float64,
+    "pct_exceeded": pl.Float64, "cnt_exceeded": pl.Float64, "pct_met": pl.Float64, "cnt_met": pl.Float64,
+    "pct_met_and_above": pl.Float64, "cnt_met_and_above": pl.Float64, "pct_nearly_met": pl.Float64, "cnt_nearly_met": pl.Float64,
+    "pct_not_met": pl.Float64, "cnt_not_met": pl.Float64,
+    "county_name": pl.Utf8,
+    "county_code": pl.Utf8, "district_code": pl.Utf8, "school_code": pl.Utf8,
+    "district_name": pl.Utf8, "school_name": pl.Utf8, "test_id": pl.Int32, "year_key": pl.Int32,
+}
+SCORE_COLS = list(SCORE_SCHEMA)
 
 @task
-def delete_scores_for_year(engine, year_key: int):
+def merge_scores_for_year(engine, year_key: int, staging_tables: list[str]):
+    """Replace year_key's fact rows with the staged loads in one transaction, then drop the staging tables"""
     logger = get_run_logger()
+    cols_sql = ", ".join(SCORE_COLS)
     with engine.begin() as con:
         logger.info(f"Deleting existing analytics.fact_scores rows for year_key={year_key}...")
         res = con.execute(text("""
             DELETE FROM analytics.fact_scores WHERE year_key = :y
         """), {"y": year_key})
-        try:
-            deleted = res.rowcount if hasattr(res, "rowcount") else None
-            if deleted is not None:
-                logger.info(f"Deleted {deleted:,} rows for year_key={year_key}")
-        except Exception:
-            pass
+        logger.info(f"Deleted {res.rowcount:,} rows for year_key={year_key}")
+
+        if staging_tables:
+            union = " UNION ALL ".join(f"SELECT {cols_sql} FROM {t}" for t in staging_tables)
+            res = con.execute(text(f"INSERT INTO analytics.fact_scores({cols_sql}) {union}"))
+            logger.info(f"Merged {res.rowcount:,} rows from {len(staging_tables)} staging tables for year_key={year_key}")
+        for t in staging_tables:
+            con.execute(text(f"DROP TABLE IF EXISTS {t}"))
+
+def drop_staging_tables(engine, staging_tables: list[str]):
+    """Drop staging tables left by a failed load or merge"""
+    if not staging_tables:
+        return
+    with engine.begin() as con:
+        for t in staging_tables:
+            con.execute(text(f"DROP TABLE IF EXISTS {t}"))
+
+# Largest share of a column's rows that may be nulled by an unparseable value before a load fails
+CAST_NULL_MAX_FRACTION = float(os.getenv("CAST_NULL_MAX_FRACTION", "0.01"))
+
+# Newer files use different names for the tested counts; each maps to the older canonical name
+_TEST_COLUMN_ALTERNATES = {
+    "total_students_tested": ["students_tested"],
+    "total_students_tested_with_scores": ["total_tested_with_scores_at_reporting_level", "students_with_scores"],
+}
+
+def canonical_test_columns(tests: pl.DataFrame) -> pl.DataFrame:
+    """Rename header variants to the canonical names; apply per file, before frames with different variants are concatenated"""
+    renames = {}
+    for canon, alts in _TEST_COLUMN_ALTERNATES.items():
+        if canon in tests.columns:
+            continue
+        found = next((a for a in alts if a in tests.columns), None)
+        if found is not None:
+            renames[found] = canon
+    return tests.rename(renames) if renames else tests
 
 @task
-def load_tests(engine, tests: pl.DataFrame, year_key: int, county_lookup: Optional[pl.DataFrame] = None):
+def load_tests(engine, tests: pl.DataFrame, year_key: int, county_lookup: Optional[pl.DataFrame] = None) -> Optional[str]:
+    """COPY one results file into its own UNLOGGED staging table and return the table name (None if nothing to load)"""
     logger = get_run_logger()
     if tests is None or tests.height == 0:
-        return
-    
-    # Normalize column names - handle both old and new formats
-    # First, standardize column names if needed
-    df = tests
+        return None
     
-    # Map new column names to old expected names
-    if "students_tested" in df.columns and "total_students_tested" not in df.columns:
-        df = df.rename({"students_tested": "total_students_tested"})
-    
-    if "total_tested_with_scores_at_reporting_level" in df.columns and "total_students_tested_with_scores" not in df.columns:
-        df = df.rename({"total_tested_with_scores_at_reporting_level": "total_students_tested_with_scores"})
-    elif "students_with_scores" in df.columns and "total_students_tested_with_scores" not in df.columns:
-        df = df.rename({"students_with_scores": "total_students_tested_with_scores"})
-    
-    # Now map to final column names for database
+    # Final column names for database, keyed by source column
     ren = {
         "student_group_id":"subgroup",
         "grade":"grade",
@@ -112,96 +224,80 @@ def load_tests(engine, tests: pl.DataFrame, year_key: int, county_lookup: Option
         "school_name":"school_name",
         "test_id":"test_id"
     }
+    tests = canonical_test_columns(tests)
+    source = {ren[c]: c for c in ren if c in tests.columns}
     
-    cols = [c for c in ren if c in df.columns]
-    rename_map = {c: ren[c] for c in cols}
-    df = df.select(cols).rename(rename_map)
-    
-    if "test_id" not in df.columns:
+    if "test_id" not in source:
         logger.warning("test_id column not found, cannot determine subject. Skipping this data.")
-        return
+        return None
+    
+    # Everything up to the COPY frame is one lazy plan: rename/projection, year_key, padding, the
+    # county join and the final casts are fused into a single collect()
+    lf = tests.lazy().select([pl.col(src).alias(dst) for dst, src in source.items()])
+    out_cols = set(source)
     
     # Add year_key immediately (no conflict)
-    df = df.with_columns(pl.lit(year_key).alias("year_key"))
-
-    # Safely pad codes by writing to temp columns, then replace originals to avoid duplicate alias errors
-    if "county_code" in df.columns:
-        df = df.with_columns(pl.col("county_code").cast(pl.Utf8).str.zfill(2).alias("county_code_p"))
-        df = df.drop(["county_code"]).rename({"county_code_p": "county_code"})
-    if "district_code" in df.columns:
-        df = df.with_columns(pl.col("district_code").cast(pl.Utf8).str.zfill(5).alias("district_code_p"))
-        df = df.drop(["district_code"]).rename({"district_code_p": "district_code"})
-    if "school_code" in df.columns:
-        df = df.with_columns(pl.col("school_code").cast(pl.Utf8).str.zfill(7).alias("school_code_p"))
-        df = df.drop(["school_code"]).rename({"school_code_p": "school_code"})
-
-    # Populate cds_code from padded codes
-    if "county_code" in df.columns and "district_code" in df.columns and "school_code" in df.columns:
-        df = df.with_columns(
-            (
-                pl.col("county_code").cast(pl.Utf8).str.zfill(2)
-                + pl.col("district_code").cast(pl.Utf8).str.zfill(5)
-                + pl.col("school_code").cast(pl.Utf8).str.zfill(7)
-            ).alias("cds_code")
-        )
+    lf = lf.with_columns(pl.lit(year_key).alias("year_key"))
+    out_cols.add("year_key")
+
+    # Zero-pad codes and derive cds_code from the padded codes in a single pass
+    widths = {"county_code": 2, "district_code": 5, "school_code": 7}
+    padded = {c: pl.col(c).cast(pl.Utf8).str.zfill(w) for c, w in widths.items() if c in out_cols}
+    exprs = [e.alias(c) for c, e in padded.items()]
+    if len(padded) == len(widths):
+        exprs.append((padded["county_code"] + padded["district_code"] + padded["school_code"]).alias("cds_code"))
+    if exprs:
+        lf = lf.with_columns(exprs)
 
     # Join county_name from entities-derived lookup if provided
-    if county_lookup is not None and "county_code" in df.columns:
-        try:
-            cl = county_lookup
-            # Ensure normalized/padded codes in the lookup as well
-            if "county_code" in cl.columns:
-                cl = cl.with_columns(
-                    pl.col("county_code").cast(pl.Utf8).str.zfill(2).alias("county_code")
-                )
-            # Only keep necessary columns and unique codes
-            keep_cols = [c for c in ["county_code", "county_name"] if c in cl.columns]
-            if "county_name" in keep_cols:
-                cl = cl.select(keep_cols).unique(subset=["county_code"], keep="first")
-                df = df.join(cl, on="county_code", how="left")
-        except Exception:
-            # Best-effort enrichment; continue without blocking load
-            pass
-
-    # Ensure COPY column order and presence to avoid positional mismatches
-    expected_cols = [
-        "subgroup", "grade", "tested", "tested_with_scores", "mean_scale_score",
-        "pct_exceeded", "cnt_exceeded", "pct_met", "cnt_met",
-        "pct_met_and_above", "cnt_met_and_above", "pct_nearly_met", "cnt_nearly_met",
-        "pct_not_met", "cnt_not_met",
-        "county_name",
-        "county_code", "district_code", "school_code",
-        "district_name", "school_name", "test_id", "year_key"
-    ]
-
-    # Add any missing columns as nulls so counts don't receive percentages by shift
-    for col in expected_cols:
-        if col not in df.columns:
-            df = df.with_columns(pl.lit(None).alias(col))
-
-    # Reorder strictly to COPY list
-    df = df.select(expected_cols)
+    if county_lookup is not None and "county_code" in out_cols:
+        cl = None
+        if {"county_code", "county_name"}.issubset(county_lookup.columns):
+            try:
+                # Normalize the (eager) lookup here so a bad lookup is caught now rather than
+                # failing the fused collect() below; the join itself is then type-safe
+                cl = county_lookup.select(
+                    pl.col("county_code").cast(pl.Utf8).str.zfill(2).alias("county_code"),
+                    pl.col("county_name").cast(pl.Utf8),
+                ).unique(subset=["county_code"], keep="first")
+            except Exception:
+                # Best-effort enrichment; continue without blocking load
+                cl = None
+        if cl is not None:
+            lf = lf.join(cl.lazy(), on="county_code", how="left")
+            out_cols.add("county_name")
+
+    # Reorder strictly to the COPY list with target dtypes, so COPY only has to parse well-formed ints/numerics.
+    # Missing columns become typed nulls so counts don't receive percentages by shift; unparseable values become
+    # null, and how many each cast introduced is checked against CAST_NULL_MAX_FRACTION below.
+    raw = lf.select([c for c in SCORE_SCHEMA if c in out_cols]).collect()
+    df = raw.select([
+        pl.col(c).cast(dtype, strict=False) if c in out_cols else pl.lit(None, dtype=dtype).alias(c)
+        for c, dtype in SCORE_SCHEMA.items()
+    ])
+    raw_nulls = raw.null_count().row(0, named=True)
+    cast_nulls = df.null_count().row(0, named=True)
+    introduced = {c: cast_nulls[c] - raw_nulls[c] for c in raw.columns if cast_nulls[c] > raw_nulls[c]}
+    if introduced:
+        logger.warning(f"Unparseable values nulled by cast for year_key={year_key}: {introduced}")
+        too_many = {c: n for c, n in introduced.items() if n > CAST_NULL_MAX_FRACTION * df.height}
+        if too_many:
+            raise ValueError(
+                f"Cast nulled more than {CAST_NULL_MAX_FRACTION:.2%} of {df.height:,} rows for year_key={year_key}: {too_many}"
+            )
     
+    # Per-task staging table: loads don't contend on fact_scores, and UNLOGGED skips WAL for the bulk write
+    stg = f"analytics.fact_scores_stg_{uuid.uuid4().hex}"
+    cols_sql = ", ".join(SCORE_COLS)
     with engine.begin() as con:
+        con.execute(text(f"CREATE UNLOGGED TABLE {stg} AS SELECT {cols_sql} FROM analytics.fact_scores WITH NO DATA"))
         raw_conn = con.connection.driver_connection
         
-        buffer = io.StringIO()
-        pandas_df = df.to_pandas()
-        pandas_df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer = io.BytesIO()
+        df.write_csv(buffer, include_header=False, null_value='\\N')
         buffer.seek(0)
         
-        copy_sql = """
-            COPY analytics.fact_scores(
-                subgroup, grade, tested, tested_with_scores, mean_scale_score,
-                pct_exceeded, cnt_exceeded, pct_met, cnt_met,
-                pct_met_and_above, cnt_met_and_above, pct_nearly_met, cnt_nearly_met,
-                pct_not_met, cnt_not_met, 
-                county_name,
-                county_code, district_code, school_code,
-                district_name, school_name, test_id, year_key
-            )
-            FROM STDIN WITH (FORMAT CSV, NULL '\\N')
-        """
+        copy_sql = f"COPY {stg}({cols_sql}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')"
         
         logger.info(f"Starting COPY command for bulk insert...")
         with raw_conn.cursor() as cursor:
@@ -211,11 +307,21 @@ def load_tests(engine, tests: pl.DataFrame, year_key: int, county_lookup: Option
                     if not data:
                         break
                     copy.write(data)
-        logger.info(f"Successfully inserted {df.shape[0]:,} rows")
+        logger.info(f"Successfully staged {df.shape[0]:,} rows in {stg}")
+    return stg
+
+VECTOR_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS analytics.vector_index_state (
+      index_name TEXT NOT NULL,
+      id TEXT NOT NULL,
+      digest BYTEA NOT NULL,
+      PRIMARY KEY (index_name, id)
+    )
+"""
 
 @task
-def build_pinecone_index(entity_dataframes: list[tuple[int, pl.DataFrame]], student_groups_df: pl.DataFrame, tests_df: pl.DataFrame):
-    """Build Pinecone index with entities (from most recent year only), student groups, tests, grades"""
+def build_pinecone_index(engine, entity_dataframes: list[tuple[int, pl.DataFrame]], student_groups_df: pl.DataFrame, tests_df: pl.DataFrame):
+    """Incrementally sync the Pinecone index with entities (from most recent year only), student groups, tests, grades"""
     logger = get_run_logger()
     
     # Check if we have any data to index
@@ -243,11 +349,18 @@ def build_pinecone_index(entity_dataframes: list[tuple[int, pl.DataFrame]], stud
     logger.info(f"Existing indexes: {existing_indexes}")
     logger.info(f"Index {index_name} already exists: {index_already_existed}")
 
+    dimension = embedding_dimension()
+    if index_already_existed and pc.describe_index(index_name).dimension != dimension:
+        # Vectors from a different embedding model can't be mixed in; rebuild the index at the new size
+        logger.info(f"Index {index_name} dimension differs from {EMBEDDING_MODEL} ({dimension}); recreating")
+        pc.delete_index(index_name)
+        index_already_existed = False
+
     if not index_already_existed:
         logger.info(f"Creating Pinecone index: {index_name}")
         pc.create_index(
             name=index_name,
-            dimension=3072,  # text-embedding-3-large dimension
+            dimension=dimension,
             metric="cosine",
             spec=ServerlessSpec(cloud="aws", region="us-east-1")
         )
@@ -258,74 +371,96 @@ def build_pinecone_index(entity_dataframes: list[tuple[int, pl.DataFrame]], stud
             time.sleep(1)
         logger.info(f"Index {index_name} is ready!")
     
-    # Initialize embeddings and vector store
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-    vector_store = PineconeVectorStore(index_name=index_name, embedding=embeddings)
+    # Initialize embeddings (up to 2048 inputs per embeddings request) and the index handle;
+    # pool_threads sizes the client's own thread pool used by async_req upserts
+    workers = int(os.getenv("EMBED_WORKERS", "8"))
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, chunk_size=2048)
+    index = pc.Index(index_name, pool_threads=workers)
     
-    texts, metadatas = [], []
+    # Deterministic vector ids (ent:<cds>, sub:<id>, test:<id>, grade:<n>) so reruns upsert in place
+    ids, texts, metadatas = [], [], []
     
-    # 1. Add entities (counties, districts, schools)
+    # 1. Add entities (counties, districts, schools) - text and metadata assembled as Polars expressions
+    payloads = []
     for year_key, ents in entity_dataframes:
         if ents is None or ents.height == 0:
             continue
         
-        for r in ents.iter_rows(named=True):
-            county_name = str(r.get("county_name") or "").strip() + " County"
-            district_name = str(r.get("district_name") or "").strip()
-            school_name = str(r.get("school_name") or "").strip()
-            county_code = str(r.get("county_code") or "").strip().zfill(2)
-            district_code = str(r.get("district_code") or "").strip().zfill(5)
-            school_code = str(r.get("school_code") or "").strip().zfill(7)
-            
-            label = " | ".join([county_name, district_name, school_name]).strip(" |")
-            text = f"{label} | County:{county_code} District:{district_code} School:{school_code}"
-            texts.append(text)
-            metadatas.append({
-                "type": "entity",
-                "county_name": county_name,
-                "district_name": district_name,
-                "school_name": school_name,
-                "county_code": county_code,
-                "district_code": district_code,
-                "school_code": school_code,
-                "year_key": year_key
-            })
+        def clean(col: str) -> pl.Expr:
+            if col not in ents.columns:
+                return pl.lit("")
+            return pl.col(col).cast(pl.Utf8).fill_null("").str.strip_chars()
+        
+        payloads.append(ents.select([
+            (clean("county_name") + pl.lit(" County")).alias("county_name"),
+            clean("district_name").alias("district_name"),
+            clean("school_name").alias("school_name"),
+            clean("county_code").str.zfill(2).alias("county_code"),
+            clean("district_code").str.zfill(5).alias("district_code"),
+            clean("school_code").str.zfill(7).alias("school_code"),
+            clean("type_id").alias("type_id"),
+            pl.lit(year_key).alias("year_key"),
+        ]))
+
+    if payloads:
+        # Entities repeat across files and years; embed each CDS code once, keeping its latest row
+        payload = pl.concat(payloads, how="vertical_relaxed").with_columns(
+            pl.concat_str(["county_name", "district_name", "school_name"], separator=" | ")
+              .str.strip_chars(" |")
+              .alias("label"),
+            pl.format("{}{}{}", "county_code", "district_code", "school_code").alias("cds_code"),
+        ).unique(subset=["cds_code"], keep="last", maintain_order=True).with_columns(
+            pl.format("{} | County:{} District:{} School:{}", "label", "county_code", "district_code", "school_code")
+              .alias("text")
+        )
+        
+        ids.extend(payload.select(pl.format("ent:{}", "cds_code")).to_series().to_list())
+        texts.extend(payload.get_column("text").to_list())
+        metadatas.extend(
+            payload.select([
+                pl.lit("entity").alias("type"),
+                "county_name", "district_name", "school_name",
+                "county_code", "district_code", "school_code", "cds_code", "type_id",
+                "year_key",
+            ]).to_dicts()
+        )
 
     logger.info(f"Number of entities added: {len(texts)}")
     currLen = len(texts)
 
     # 2. Add student groups/subgroups
     if student_groups_df is not None and student_groups_df.height > 0:
-        for r in student_groups_df.iter_rows(named=True):
-            demo_name = str(r.get("demographic_name", ""))
-            demo_id = int(r.get("demographic_id_num", ""))
-            student_group = str(r.get("student_group", ""))
-            
-            text = f"{demo_name} (Subgroup ID: {demo_id}, Category: {student_group})"
-            texts.append(text)
-            metadatas.append({
-                "type": "subgroup",
-                "demographic_name": demo_name,
-                "demographic_id": demo_id,
-                "student_group": student_group
-            })
+        payload = student_groups_df.select([
+            pl.col("demographic_name").cast(pl.Utf8).fill_null(""),
+            pl.col("demographic_id_num").cast(pl.Int64).alias("demographic_id"),
+            pl.col("student_group").cast(pl.Utf8).fill_null(""),
+        ])
+        ids.extend(payload.select(pl.format("sub:{}", "demographic_id")).to_series().to_list())
+        texts.extend(
+            payload.select(
+                pl.format("{} (Subgroup ID: {}, Category: {})", "demographic_name", "demographic_id", "student_group")
+            ).to_series().to_list()
+        )
+        metadatas.extend(
+            payload.select([pl.lit("subgroup").alias("type"), "demographic_name", "demographic_id", "student_group"]).to_dicts()
+        )
 
     logger.info(f"Number of student groups added: {len(texts) - currLen}")
     currLen = len(texts)
 
     # 3. Add tests
     if tests_df is not None and tests_df.height > 0:
-        for r in tests_df.iter_rows(named=True):
-            test_name = str(r.get("test_name", ""))
-            test_id = int(r.get("test_id_num", ""))
-            
-            text = f"{test_name} (Test ID: {test_id})"
-            texts.append(text)
-            metadatas.append({
-                "type": "test",
-                "test_name": test_name,
-                "test_id": test_id
-            })
+        payload = tests_df.select([
+            pl.col("test_name").cast(pl.Utf8).fill_null(""),
+            pl.col("test_id_num").cast(pl.Int64).alias("test_id"),
+        ])
+        ids.extend(payload.select(pl.format("test:{}", "test_id")).to_series().to_list())
+        texts.extend(
+            payload.select(pl.format("{} (Test ID: {})", "test_name", "test_id")).to_series().to_list()
+        )
+        metadatas.extend(
+            payload.select([pl.lit("test").alias("type"), "test_name", "test_id"]).to_dicts()
+        )
 
     logger.info(f"Number of tests added: {len(texts) - currLen}")
     currLen = len(texts)
@@ -334,39 +469,121 @@ def build_pinecone_index(entity_dataframes: list[tuple[int, pl.DataFrame]], stud
     grades = [3, 4, 5, 6, 7, 8, 11, 13]
     for grade in grades:
         grade = int(grade)
+        ids.append(f"grade:{grade}")
         texts.append(f"Grade {grade}" if grade != 13 else "All Grades")
         metadatas.append({"type": "grade", "grade": grade})
 
     logger.info(f"Number of grades added {len(texts) - currLen}")
     currLen = len(texts)
 
-    # Upload to Pinecone in batches
-    if texts:
-        logger.info(f"Uploading {len(texts)} entities to Pinecone index: {index_name}")
+    # One vector per id; keep the first occurrence (and its text/metadata) only
+    first_idx = {}
+    for i, vid in enumerate(ids):
+        first_idx.setdefault(vid, i)
+    if len(first_idx) < len(ids):
+        logger.info(f"Dropping {len(ids) - len(first_idx)} duplicate ids before embedding")
+        ids = list(first_idx)
+        texts = [texts[i] for i in first_idx.values()]
+        metadatas = [metadatas[i] for i in first_idx.values()]
+
+    # Diff against what the index already holds: analytics.vector_index_state records a digest of each
+    # id's model/text/metadata as last upserted. A new or recreated index starts from an empty state.
+    digests = [
+        hashlib.blake2b(f"{EMBEDDING_MODEL}\0{t}\0{json.dumps(m, sort_keys=True)}".encode("utf-8"), digest_size=16).digest()
+        for t, m in zip(texts, metadatas)
+    ]
+    with engine.begin() as con:
+        # Mirrors db/ddl.sql, so databases created before the state table existed get it here
+        con.execute(text(VECTOR_STATE_DDL))
+        if not index_already_existed:
+            con.execute(text("DELETE FROM analytics.vector_index_state WHERE index_name = :n"), {"n": index_name})
+        state = dict(con.execute(
+            text("SELECT id, digest FROM analytics.vector_index_state WHERE index_name = :n"), {"n": index_name}
+        ).all())
+    if index_already_existed and not state:
+        # An existing index with no recorded state was built before deterministic ids (random UUIDs from
+        # add_texts); nothing could delete those vectors by id, so start it over
+        logger.info(f"No recorded state for existing index {index_name}; clearing it before a full upload")
+        index.delete(delete_all=True)
+    changed = [i for i, (vid, d) in enumerate(zip(ids, digests)) if state.get(vid) != d]
+    current = set(ids)
+    stale = [vid for vid in state if vid not in current]
+    logger.info(f"Index diff: {len(changed)} new/changed, {len(ids) - len(changed)} unchanged, {len(stale)} stale")
+
+    if stale:
+        logger.info(f"Deleting {len(stale)} stale vectors from Pinecone index: {index_name}")
+        for i in range(0, len(stale), 1000):
+            index.delete(ids=stale[i:i+1000])
+
+    # Upload new/changed vectors to Pinecone in batches
+    if changed:
+        logger.info(f"Uploading {len(changed)} entities to Pinecone index: {index_name}")
+        up_ids = [ids[i] for i in changed]
+        up_texts = [texts[i] for i in changed]
+        up_metas = [metadatas[i] for i in changed]
         
-        # Clear existing data only if index already existed
-        if index_already_existed:
-            logger.info(f"Clearing existing data from Pinecone index: {index_name}")
-            try:
-                pc.Index(index_name).delete(delete_all=True)
-            except NotFoundException:
-                # If namespace doesn't exist (empty index), that's fine - nothing to clear
-                logger.info(f"No existing data to clear (namespace not found) - index is empty")
+        # Reuse vectors from previous runs; only texts never seen with this model are embedded
+        cache = EmbeddingCache(embeddings.model)
+        vectors = cache.get_many(up_texts)
+        miss_idx = [i for i, v in enumerate(vectors) if v is None]
+        miss_texts = [up_texts[i] for i in miss_idx]
+        logger.info(f"Embedding cache: {len(up_texts) - len(miss_idx)} hits, {len(miss_idx)} misses")
         
-        # Add in batches
+        # Embed misses up front, decoupled from the upsert batch size. Requests are IO-bound,
+        # so shards of one embeddings request each are sent in parallel; map() keeps them in order.
+        embed_chunk = 2048
+        shards = [miss_texts[i:i+embed_chunk] for i in range(0, len(miss_texts), embed_chunk)]
+        logger.info(f"Embedding {len(miss_texts)} texts in {len(shards)} shards ({workers} workers)...")
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            miss_vecs = [vec for shard_vecs in ex.map(embeddings.embed_documents, shards) for vec in shard_vecs]
+        for i, vec in zip(miss_idx, miss_vecs):
+            vectors[i] = vec
+        try:
+            cache.put_many(miss_texts, miss_vecs)
+        finally:
+            cache.close()
+        
+        # Upsert vectors directly; "text" is the metadata key PineconeVectorStore reads page_content from.
+        # Batches stay well under Pinecone's 2MB request limit even for 3072-dim vectors.
         logger.info(f"Adding data to Pinecone index: {index_name}")
-        batch_size = 100
-        for i in range(0, len(texts), batch_size):
-            batch_texts = texts[i:i+batch_size]
-            batch_metas = metadatas[i:i+batch_size]
-            vector_store.add_texts(batch_texts, metadatas=batch_metas)
-            logger.info(f"Uploaded batch {i//batch_size + 1}/{(len(texts)-1)//batch_size + 1}")
+        batch_size = 64
+        batches = [
+            [
+                (vid, vec, {**meta, "text": t})
+                for vid, t, vec, meta in zip(
+                    up_ids[i:i+batch_size], up_texts[i:i+batch_size], vectors[i:i+batch_size], up_metas[i:i+batch_size]
+                )
+            ]
+            for i in range(0, len(up_ids), batch_size)
+        ]
+        pending = [index.upsert(vectors=batch, async_req=True) for batch in batches]
+        for n, res in enumerate(pending, 1):
+            res.get()
+            logger.info(f"Uploaded batch {n}/{len(batches)}")
         
-        logger.info(f"Successfully uploaded {len(texts)} entities to Pinecone")
-
-@flow(name="caaspp_last_3_years")
+        logger.info(f"Successfully uploaded {len(changed)} entities to Pinecone")
+
+    # Record what the index now holds
+    if changed or stale:
+        with engine.begin() as con:
+            if stale:
+                con.execute(
+                    text("DELETE FROM analytics.vector_index_state WHERE index_name = :n AND id = ANY(:ids)"),
+                    {"n": index_name, "ids": stale},
+                )
+            if changed:
+                con.execute(text("""
+                    INSERT INTO analytics.vector_index_state(index_name, id, digest)
+                    SELECT :n, t.id, t.digest
+                    FROM unnest(CAST(:ids AS text[]), CAST(:digests AS bytea[])) AS t(id, digest)
+                    ON CONFLICT (index_name, id) DO UPDATE SET digest = EXCLUDED.digest
+                """), {"n": index_name, "ids": [ids[i] for i in changed], "digests": [digests[i] for i in changed]})
+
+# Downloads, loads and the index build are IO-bound; run submitted/mapped tasks on a thread pool
+@flow(name="caaspp_last_3_years", task_runner=ThreadPoolTaskRunner(max_workers=int(os.getenv("FLOW_MAX_WORKERS", "16"))))
 def caaspp_last_3_years():
     logger = get_run_logger()
+    ensure_data_dir()
     engine = create_engine(PG_URL, pool_pre_ping=True)
 
     now = datetime.datetime.utcnow()
@@ -406,53 +623,102 @@ def caaspp_last_3_years():
     entity_dataframes = []
     load_tasks = []
 
-    for y in range(latest_year - last_years + 1, latest_year + 1):
-        logger.info(f"Processing year {y} (latest_year={latest_year})")
-        # Ensure we start fresh for this year: remove any previously loaded rows
-        delete_scores_for_year.submit(engine, y)
-        page = http_get.submit(CAASPP_LIST.format(year=y))
-        zips = caret_zip_urls.submit(page)
-        zip_urls = zips.result()
-        logger.info(f"Found {len(zip_urls)} zip files for year {y}")
+    years = list(range(latest_year - last_years + 1, latest_year + 1))
+
+    # Downloads are latency/bandwidth bound: fetch every year's list page, then start every zip
+    # download, before consuming any of them
+    pages = http_get.map([CAASPP_LIST.format(year=y) for y in years])
+    zip_urls_by_year = dict(zip(years, caret_zip_urls.map(pages).result()))
+    all_urls = [u for y in years for u in zip_urls_by_year[y]]
+    # Each parse starts as soon as its own download finishes
+    parse_futs = dict(zip(all_urls, parse_zip_task.map(http_download.map(all_urls))))
+    parsed = {y: [(u, parse_futs[u]) for u in zip_urls_by_year[y]] for y in years}
+
+    staged = {y: [] for y in years}
+    collected = False
+
+    def collect_loads() -> list:
+        """Wait on every submitted load (not just up to the first failure) so all staging tables are known"""
+        failed = []
+        for y, load_fut in load_tasks:
+            try:
+                stg = load_fut.result()
+            except Exception as e:
+                logger.error(f"load_tests failed for year {y}: {e}")
+                failed.append(e)
+                continue
+            if stg is not None:
+                staged[y].append(stg)
+        return failed
+
+    # Everything from the first download wait through the merges is covered, so staging tables from
+    # loads already submitted are dropped even when a later year's download or parse fails
+    try:
+        for y in years:
+            logger.info(f"Processing year {y} (latest_year={latest_year})")
+            logger.info(f"Found {len(zip_urls_by_year[y])} zip files for year {y}")
+            year_tests, year_lookups = [], []
         
-        for u in zip_urls:
-            logger.info(f"Downloading {u}")
-            zb = http_get.submit(u)
-            parts = parse_zip_caret(zb.result(), logger=logger)
+            for u, pf in parsed[y]:
+                logger.info(f"Waiting for download/parse of {u}")
+                parts = pf.result()
             
-            # log what we got
-            logger.info(f"Entities: {parts['entities'].height if parts['entities'] is not None else 'None'} rows")
-            logger.info(f"Tests: {parts['tests'].height if parts['tests'] is not None else 'None'} rows")
+                # log what we got
+                logger.info(f"Entities: {parts['entities'].height if parts['entities'] is not None else 'None'} rows")
+                logger.info(f"Tests: {parts['tests'].height if parts['tests'] is not None else 'None'} rows")
             
-            # load tests/results (enrich with county_name via entities lookup when available)
-            county_lookup = None
-            ents_for_lookup = parts.get("entities")
-            if ents_for_lookup is not None and {"county_code","county_name"}.issubset(set(ents_for_lookup.columns)):
-                county_lookup = ents_for_lookup.select(["county_code","county_name"]).unique(subset=["county_code"], keep="first")
-
-            task = load_tests.submit(engine, parts["tests"], y, county_lookup)
-            load_tasks.append(task)
+                # collect tests/results for this year (enrich with county_name via entities lookup when available)
+                if parts["tests"] is not None and parts["tests"].height > 0:
+                    # Same names in every frame, so the diagonal concat lines variants up instead of nulling them
+                    year_tests.append(canonical_test_columns(parts["tests"]))
+                ents_for_lookup = parts.get("entities")
+                if ents_for_lookup is not None and {"county_code","county_name"}.issubset(set(ents_for_lookup.columns)):
+                    year_lookups.append(ents_for_lookup.select(["county_code","county_name"]))
             
-            # Parse and prepare entities for Pinecone (only for latest year)
-            if y == latest_year:
-                logger.info(f"Year {y} matches latest_year {latest_year}, collecting entities...")
-                ents = parts["entities"]
-                if ents is not None and ents.height > 0:
-                    keep = [c for c in ["county_code","district_code","school_code","type_id","test_year","county_name","district_name","school_name","zip_code"] if c in ents.columns]
-                    ents = ents.select(keep).with_columns(pl.lit(y).alias("year_key"))
-                    entity_dataframes.append((y, ents))
-                    logger.info(f"Collected {ents.height} entities for year {y}")
-                else:
-                    logger.warning(f"No entities found for year {y}")
-
-    # Wait for all load_tests tasks to complete
-    logger.info("Waiting for all load_tests tasks to complete...")
-    for task in load_tasks:
-        task.wait()
-    logger.info("All load_tests tasks completed")
+                # Parse and prepare entities for Pinecone (only for latest year)
+                if y == latest_year:
+                    logger.info(f"Year {y} matches latest_year {latest_year}, collecting entities...")
+                    ents = parts["entities"]
+                    if ents is not None and ents.height > 0:
+                        keep = [c for c in ["county_code","district_code","school_code","type_id","test_year","county_name","district_name","school_name","zip_code"] if c in ents.columns]
+                        ents = ents.select(keep).with_columns(pl.lit(y).alias("year_key"))
+                        entity_dataframes.append((y, ents))
+                        logger.info(f"Collected {ents.height} entities for year {y}")
+                    else:
+                        logger.warning(f"No entities found for year {y}")
+
+            # One load (one COPY, one staging table) per year rather than per zip
+            if year_tests:
+                tests_y = year_tests[0] if len(year_tests) == 1 else pl.concat(year_tests, how="diagonal_relaxed")
+                county_lookup = None
+                if year_lookups:
+                    county_lookup = pl.concat(year_lookups, how="vertical_relaxed").unique(subset=["county_code"], keep="first")
+                load_tasks.append((y, load_tests.submit(engine, tests_y, y, county_lookup)))
+
+        # Wait for all load_tests tasks to complete
+        logger.info("Waiting for all load_tests tasks to complete...")
+        failed = collect_loads()
+        collected = True
+        logger.info("All load_tests tasks completed")
+        if failed:
+            raise failed[0]
+
+        # Swap each year's rows for its staged loads atomically (delete + insert in one transaction)
+        merges = [merge_scores_for_year.submit(engine, y, staged[y]) for y in years]
+        # Let every merge finish before raising, so cleanup never races a running one
+        for m in merges:
+            m.wait()
+        for m in merges:
+            m.result()
+    except BaseException:
+        if not collected:
+            collect_loads()
+        # A successful merge already dropped its tables; the rest would otherwise be left behind
+        drop_staging_tables(engine, [t for tables in staged.values() for t in tables])
+        raise
 
     # Build Pinecone index with entity data from latest year only
-    build_pinecone_index.submit(entity_dataframes, student_groups_df, tests_df)
+    build_pinecone_index.submit(engine, entity_dataframes, student_groups_df, tests_df)
 
 if __name__ == "__main__":
     caaspp_last_3_years()
@@ -1,23 +1,63 @@
-import io, re, zipfile
+import functools, io, re, zipfile
 import polars as pl
 import logging
 
+_NORM_RE = re.compile(r"[^a-z0-9]+")
+
+@functools.lru_cache(maxsize=2048)
+def _norm_name(c: str) -> str:
+    # CAASPP files share headers, so each distinct header is normalized once per process
+    return _NORM_RE.sub("_", c.lower()).strip("_")
+
 def _norm(df: pl.DataFrame) -> pl.DataFrame:
-    return df.rename({c: re.sub(r"[^a-z0-9]+","_",c.lower()).strip("_") for c in df.columns})
+    return df.rename({c: _norm_name(c) for c in df.columns})
+
+def _csv_source(src):
+    # Raw bytes or an open binary file object (e.g. a zip member from ZipFile.open)
+    return io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src
+
+def read_caret_csv(src, columns=None) -> pl.DataFrame:
+    return pl.read_csv(_csv_source(src), separator="^", columns=columns, infer_schema_length=50000, null_values=["","NA","N/A", "*"], encoding="utf8-lossy")
 
-def read_caret_csv(raw: bytes) -> pl.DataFrame:
-    return pl.read_csv(io.BytesIO(raw), separator="^", infer_schema_length=50000, null_values=["","NA","N/A", "*"], encoding="utf8-lossy")
+def read_comma_csv(src) -> pl.DataFrame:
+    return pl.read_csv(_csv_source(src), separator=",", infer_schema_length=50000, null_values=["","NA","N/A", "*"], encoding="utf8-lossy")
 
-def read_comma_csv(raw: bytes) -> pl.DataFrame:
-    return pl.read_csv(io.BytesIO(raw), separator=",", infer_schema_length=50000, null_values=["","NA","N/A", "*"], encoding="utf8-lossy")
+# Normalized columns the ingest flow uses from each research file type; everything else is never parsed
+TESTS_COLUMNS = frozenset({
+    "test_type", "test_id", "student_group_id", "grade",
+    "total_students_tested", "students_tested",
+    "total_students_tested_with_scores", "total_tested_with_scores_at_reporting_level", "students_with_scores",
+    "mean_scale_score",
+    "percentage_standard_exceeded", "count_standard_exceeded",
+    "percentage_standard_met", "count_standard_met",
+    "percentage_standard_met_and_above", "count_standard_met_and_above",
+    "percentage_standard_nearly_met", "count_standard_nearly_met",
+    "percentage_standard_not_met", "count_standard_not_met",
+    "county_code", "district_code", "school_code", "district_name", "school_name",
+})
+ENTITY_COLUMNS = frozenset({
+    "county_code", "district_code", "school_code", "type_id", "test_year",
+    "county_name", "district_name", "school_name", "zip_code",
+})
 
-def parse_zip_caret(zip_bytes: bytes, logger=None):
+# Bump whenever parse_zip_caret's output changes in a way the column sets above don't capture
+# (dtypes, null handling, classification); part of the ingest flow's parse-cache key
+PARSER_VERSION = 2
+
+def _read_header(z: zipfile.ZipFile, name: str) -> list[str]:
+    """Raw caret-delimited header names of a zip member, without parsing the body"""
+    with z.open(name) as fh:
+        line = fh.readline()
+    return [h.strip().strip('"') for h in line.decode("utf-8-sig", errors="replace").rstrip("\r\n").split("^")]
+
+def parse_zip_caret(zip_src, logger=None):
+    """Parse a CAASPP research zip given as a file path or raw bytes"""
     out = {"entities": None, "tests": None}
     if logger is None:
         logger = logging.getLogger(__name__)
     
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as z:
+        with zipfile.ZipFile(io.BytesIO(zip_src) if isinstance(zip_src, (bytes, bytearray)) else zip_src) as z:
             filenames = z.namelist()
             logger.info(f"Zip contains {len(filenames)} files: {filenames}")
             
@@ -27,20 +67,28 @@ def parse_zip_caret(zip_bytes: bytes, logger=None):
                 if not (name.lower().endswith(".csv") or name.lower().endswith(".txt")): 
                     continue
                 
-                logger.info(f"Reading {name} ({z.getinfo(name).file_size} bytes)...")
-                raw = z.read(name)
-                
-                df = _norm(read_caret_csv(raw))
-                
-                cols = set(df.columns)
-                if {"test_type","test_id","student_group_id","mean_scale_score"}.issubset(cols) and \
-                   ("total_students_tested_with_scores" in cols or "total_tested_with_scores_at_reporting_level" in cols):
-                    out["tests"] = df
-                elif {"county_code","district_code","school_code","type_id","test_year"}.issubset(cols) and \
-                     "test_type" not in cols:
-                    out["entities"] = df
-                else:
-                    logger.warning(f"File {name} doesn't match entities or tests schema. Columns: {cols}")
+                # A bad member is logged and skipped; it must not cost the zip's other files
+                try:
+                    # Classify from the header alone, then parse only the columns that file type needs
+                    header = _read_header(z, name)
+                    cols = {_norm_name(h) for h in header}
+                    if {"test_type","test_id","student_group_id","mean_scale_score"}.issubset(cols) and \
+                       ("total_students_tested_with_scores" in cols or "total_tested_with_scores_at_reporting_level" in cols):
+                        part, wanted = "tests", TESTS_COLUMNS
+                    elif {"county_code","district_code","school_code","type_id","test_year"}.issubset(cols) and \
+                         "test_type" not in cols:
+                        part, wanted = "entities", ENTITY_COLUMNS
+                    else:
+                        logger.warning(f"File {name} doesn't match entities or tests schema. Columns: {cols}")
+                        continue
+                    
+                    logger.info(f"Reading {name} ({z.getinfo(name).file_size} bytes)...")
+                    # Select by position: the cleaned names from _read_header may not match Polars' raw header
+                    wanted_idx = [i for i, h in enumerate(header) if _norm_name(h) in wanted]
+                    with z.open(name) as fh:
+                        out[part] = _norm(read_caret_csv(fh, columns=wanted_idx))
+                except Exception as e:
+                    logger.error(f"Error parsing {name}: {e}", exc_info=True)
     except Exception as e:
         logger.error(f"Error parsing zip file: {e}", exc_info=True)
     
@@ -0,0 +1,47 @@
+"""Compile app/sql_examples.json into an importable Python module.
+
+Importing the generated module (from its cached .pyc) is cheaper than opening and
+parsing the JSON file on every worker start. The module records the SHA-256 of the JSON it
+was built from; app/agent.py falls back to the JSON whenever that no longer matches. Re-run
+after editing sql_examples.json (the Docker build also runs it):
+
+    python scripts/compile_examples.py
+    python scripts/compile_examples.py --check   # exit 1 if the module is stale (for CI)
+"""
+import hashlib
+import json
+import pprint
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SOURCE = PROJECT_ROOT / "app" / "sql_examples.json"
+TARGET = PROJECT_ROOT / "app" / "_sql_examples_compiled.py"
+
+
+def render() -> str:
+    raw = SOURCE.read_bytes()
+    examples = json.loads(raw)
+    body = pprint.pformat(examples, indent=4, width=100, sort_dicts=False)
+    return (
+        "# Generated by scripts/compile_examples.py from app/sql_examples.json. Do not edit.\n"
+        f"SOURCE_SHA256 = {hashlib.sha256(raw).hexdigest()!r}\n"
+        f"EXAMPLES = {body}\n"
+    )
+
+
+def main(argv: list[str]) -> int:
+    text = render()
+    if "--check" in argv:
+        current = TARGET.read_text(encoding="utf-8") if TARGET.exists() else None
+        if current != text:
+            print(f"{TARGET.relative_to(PROJECT_ROOT)} is stale; run python scripts/compile_examples.py")
+            return 1
+        return 0
+    TARGET.write_text(text, encoding="utf-8")
+    print(f"Wrote examples to {TARGET.relative_to(PROJECT_ROOT)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))